@@ -9,5 +9,6 @@ setup(
     description='openapi for starlette',
     packages=find_packages(),
     install_requires=['starlette'],
+    extras_require={'orjson': ['orjson']},
     include_package_data=True
 )
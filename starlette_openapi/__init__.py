@@ -1,58 +1,172 @@
-from starlette.responses import JSONResponse
+from starlette.responses import Response
 from starlette.applications import Starlette
 from starlette_pydantic import PydanticEndpoint, BaseForm
 from pydantic import BaseModel
-from pydantic.schema import get_model_name_map, schema
-import simplejson
+
+try:
+    from pydantic.schema import get_model_name_map, schema
+    _PYDANTIC_V2 = False
+except ImportError:
+    from pydantic.json_schema import models_json_schema
+    _PYDANTIC_V2 = True
+
+    def get_model_name_map(models):
+        name_groups = {}
+        for model in models:
+            name_groups.setdefault(model.__name__, []).append(model)
+
+        name_map = {}
+        for name, group in name_groups.items():
+            if len(group) == 1:
+                name_map[group[0]] = name
+            else:
+                for model in group:
+                    name_map[model] = (model.__module__ + '__' + model.__qualname__).replace('.', '__')
+        return name_map
+
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import json
+import sys
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+
+@functools.lru_cache(maxsize=None)
+def _is_pydantic_endpoint(endpoint):
+    return isinstance(endpoint, type) and issubclass(endpoint, PydanticEndpoint)
+
+
+@functools.lru_cache(maxsize=None)
+def _endpoint_methods(endpoint):
+    return tuple(method for method in OpenApiPath.operations if hasattr(endpoint, method))
+
+
+@functools.lru_cache(maxsize=None)
+def _analyze_handler(handler, path_params):
+    entries = []
+    models = []
+    for ann_name, ann in handler.__annotations__.items():
+        model = ann
+        if isinstance(ann, type):
+            if issubclass(ann, BaseModel):
+                models.append(ann)
+            if issubclass(ann, BaseForm):
+                model = ann.model_cls
+                models.append(model)
+
+        if ann_name in ('return', 'body', 'form'):
+            kind = ann_name
+        elif ann_name in path_params:
+            kind = 'path'
+        else:
+            kind = 'query'
+        entries.append((ann_name, kind, model))
+    return tuple(entries), tuple(models)
+
+
+@functools.lru_cache(maxsize=None)
+def _schema_ref(schema_name):
+    return {'schema': {"$ref": "#/components/schemas/" + sys.intern(schema_name)}}
+
+
+_SCHEMA_CACHE = {}
+
+
+def _schema_definitions(model_list):
+    cache_key = frozenset(model_list)
+    definitions = _SCHEMA_CACHE.get(cache_key)
+    if definitions is not None:
+        return definitions
+
+    if _PYDANTIC_V2:
+        _, definitions = models_json_schema([(model, 'validation') for model in model_list],
+                                            ref_template='#/components/schemas/{model}')
+        definitions = definitions.get('$defs', {})
+    else:
+        definitions = schema(model_list, title='Pydantic_Schemas')['definitions']
+
+    _SCHEMA_CACHE[cache_key] = definitions
+    return definitions
 
 
 class OpenApiObj(object):
+    __slots__ = ('_dirty',)
     fixed_fields = []
+    _field_set = frozenset()
+    _out_keys = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._field_set = frozenset(cls.fixed_fields)
+        cls._out_keys = {field: '$ref' if field == 'ref' else 'in' if field == 'location_in' else field
+                         for field in cls.fixed_fields}
+        _DISPATCH[cls] = _render_obj
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in self._field_set:
+            try:
+                dirty = self._dirty
+            except AttributeError:
+                dirty = {}
+                object.__setattr__(self, '_dirty', dirty)
+            if value is None:
+                dirty.pop(name, None)
+            else:
+                dirty[name] = None
 
     def dict(self):
         result = {}
-        for field in self.fixed_fields:
-            if not hasattr(self, field):
-                continue
+        try:
+            dirty = self._dirty
+        except AttributeError:
+            return result
 
+        out_keys = self._out_keys
+        for field in dirty:
             value = getattr(self, field)
-            if value is None:
-                continue
-
-            if isinstance(value, OpenApiObj):
+            handler = _DISPATCH.get(type(value))
+            if handler is not None:
+                value = handler(value)
+            elif isinstance(value, OpenApiObj):
                 value = value.dict()
 
-            elif isinstance(value, list):
-                tmp_value = []
-                for a in value:
-                    if isinstance(a, OpenApiObj):
-                        tmp_value.append(a.dict())
-                    else:
-                        tmp_value.append(a)
-                value = tmp_value
-            elif isinstance(value, dict):
-                tmp_value = {}
-                for k, v in value.items():
-                    if isinstance(v, OpenApiObj):
-                        tmp_value[k] = v.dict()
-                    else:
-                        tmp_value[k] = v
-                value = tmp_value
-
-            if field == "ref":
-                field = '$ref'
-            elif field == 'location_in':
-                field = "in"
-
-            result[field] = value
+            result[out_keys[field]] = value
         return result
 
     def json(self):
-        return simplejson.dumps(self.dict())
+        return _json_dumps(self.dict()).decode()
+
+
+def _render_obj(value):
+    return value.dict()
+
+
+def _render_list(value):
+    return [a.dict() if isinstance(a, OpenApiObj) else a for a in value]
+
+
+def _render_dict(value):
+    return {k: v.dict() if isinstance(v, OpenApiObj) else v for k, v in value.items()}
+
+
+_DISPATCH = {list: _render_list, dict: _render_dict}
 
 
 class OpenApiData(OpenApiObj):
     fixed_fields = ['openapi', 'info', 'servers', 'paths', 'components', 'security', 'tags', 'externalDocs']
+    __slots__ = tuple(fixed_fields)
 
     def __init__(self, openapi, info, paths, components=None):
         self.openapi = openapi or "3.0.3"
@@ -67,6 +181,7 @@ class OpenApiData(OpenApiObj):
 
 class OpenApiInfo(OpenApiObj):
     fixed_fields = ['title', 'description', 'termsOfService', 'contact', 'license', 'version']
+    __slots__ = tuple(fixed_fields)
 
     def __init__(self, title, version, description="", contact=None, license=None):
         self.title = title
@@ -79,13 +194,14 @@ class OpenApiInfo(OpenApiObj):
 
 class OpenApiSecuritySchema(OpenApiObj):
     fixed_fields = ["type", "description", "name", "location_in", "scheme", "bearerFormat", "flows", "openIdConnectUrl"]
+    __slots__ = tuple(fixed_fields)
 
     def __init__(self):
         self.type = None
         self.description = None
         self.name = None
         self.location_in = None
-        self.schema = None
+        self.scheme = None
         self.bearerFormat = None
         self.flows = None
         self.openIdConnectUrl = None
@@ -94,6 +210,7 @@ class OpenApiSecuritySchema(OpenApiObj):
 class OpenApiComponents(OpenApiObj):
     fixed_fields = ['schemas', 'responses', 'parameters', 'examples', 'requestBodies',
                     'headers', 'securitySchemes', 'links', 'callbacks']
+    __slots__ = tuple(fixed_fields)
 
     def __init__(self):
         self.schemas = {}
@@ -115,6 +232,7 @@ class OpenApiComponents(OpenApiObj):
 
 class OpenApiOperationParameter(OpenApiObj):
     fixed_fields = ['name', 'location_in', 'description', 'required', 'deprecated', 'allowEmptyValue', 'type']
+    __slots__ = tuple(fixed_fields) + ('_dict_cache',)
 
     def __init__(self, name, location_in, required, description=None, deprecated=None, allowEmptyValue=None):
         self.name = name
@@ -125,41 +243,53 @@ class OpenApiOperationParameter(OpenApiObj):
         self.allowEmptyValue = allowEmptyValue
         self.type = None
 
+    def dict(self):
+        cached = getattr(self, '_dict_cache', None)
+        if cached is None:
+            cached = super().dict()
+            self._dict_cache = cached
+        return cached
+
+
+@functools.lru_cache(maxsize=None)
+def _operation_parameter(name, location_in, required):
+    return OpenApiOperationParameter(name=name, location_in=location_in, required=required)
+
+
+class OpenApiContentObj(OpenApiObj):
+    __slots__ = ()
+
+    def add_schema_content(self, media_type, schema_name, examples=None):
+        content = _schema_ref(schema_name)
+        if examples:
+            content = dict(content)
+            content['examples'] = examples
+        self.content[media_type] = content
+
 
-class OpenApiOperationRequest(OpenApiObj):
+class OpenApiOperationRequest(OpenApiContentObj):
     fixed_fields = ['description', 'required', 'content']
+    __slots__ = tuple(fixed_fields)
 
     def __init__(self, required=True, description=None):
         self.content = {}
         self.required = required
         self.description = description
 
-    def add_schema_content(self, media_type, schema_name, examples=None):
-        self.content[media_type] = {
-            'schema': {"$ref": "#/components/schemas/" + schema_name}
-        }
-        if examples:
-            self.content[media_type]['examples'] = examples
-
 
-class OpenApiOperationResponse(OpenApiObj):
+class OpenApiOperationResponse(OpenApiContentObj):
     fixed_fields = ['description', 'headers', 'content', 'links']
+    __slots__ = tuple(fixed_fields)
 
     def __init__(self, description, headers=None, content=None, links=None):
         self.description = description
-        self.header = headers or {}
+        self.headers = headers or {}
         self.content = content or {}
         self.links = links or {}
 
-    def add_schema_content(self, media_type, schema_name, examples=None):
-        self.content[media_type] = {
-            'schema': {"$ref": "#/components/schemas/" + schema_name}
-        }
-        if examples:
-            self.content[media_type]['examples'] = examples
-
 
 class OpenApiOperationSeucirty(OpenApiObj):
+    __slots__ = ('name', 'scopes')
 
     def __init__(self, name, scopes=None):
         self.name = name
@@ -172,6 +302,7 @@ class OpenApiOperationSeucirty(OpenApiObj):
 class OpenApiOperation(OpenApiObj):
     fixed_fields = ['tags', 'consumes', 'produces', 'summary', 'description', 'externalDocs', 'operationId',
                     'parameters', 'requestBody', 'responses', 'callbacks', 'deprecated', 'security', 'servers']
+    __slots__ = tuple(fixed_fields)
 
     def __init__(self):
         self.tags = []
@@ -206,6 +337,7 @@ class OpenApiPath(OpenApiObj):
     operations = ['get', 'put', 'post', 'delete', 'options', 'head', 'patch', 'trace']
     other_fields = ['ref', 'summary', 'description', 'servers', 'parameters']
     fixed_fields = operations + other_fields
+    __slots__ = tuple(fixed_fields)
 
     def __init__(self):
         self.ref = None
@@ -219,6 +351,7 @@ class OpenApiPath(OpenApiObj):
 
 
 class OpenApiPaths(OpenApiObj):
+    __slots__ = ('paths',)
 
     def __init__(self):
         self.paths = {}
@@ -227,10 +360,7 @@ class OpenApiPaths(OpenApiObj):
         self.paths[url] = path
 
     def dict(self):
-        result = {}
-        for k, v in self.paths.items():
-            result[k] = v.dict()
-        return result
+        return {k: v.dict() for k, v in self.paths.items()}
 
 
 class OpenApi(object):
@@ -243,35 +373,41 @@ class OpenApi(object):
         self.version = version
 
         self.api_schemas = None
+        self.api_bytes = None
+        self.api_headers = None
+        self.etag = None
         self.components = []
         self.securitySchemas_index = {}
         self.token_url = None
         self.models_name = None
+        self._path_cache = {}
+        self._operation_cache = {}
 
         self.app.add_route(self.api_url, self.get_openapi_data, include_in_schema=False)
+        if hasattr(self.app, 'add_event_handler'):
+            self.app.add_event_handler("startup", self._build)
 
     def is_pydantic_endpoint(self, endpoint):
-        return isinstance(endpoint, type) and issubclass(endpoint, PydanticEndpoint)
+        return _is_pydantic_endpoint(endpoint)
 
-    def get_models_name(self):
-        models = set()
+    def _walk_routes(self):
         for route in self.app.routes:
             endpoint = route.endpoint
-            if not self.is_pydantic_endpoint(endpoint):
+            if not _is_pydantic_endpoint(endpoint):
                 continue
 
-            for method in OpenApiPath.operations:
-                if not hasattr(endpoint, method):
-                    continue
-
+            for method in _endpoint_methods(endpoint):
                 handler = getattr(endpoint, method)
-                method_annotations = handler.__annotations__
-                for ann_name, ann in method_annotations.items():
-                    if isinstance(ann, type):
-                        if issubclass(ann, BaseModel):
-                            models.add(ann)
-                        if issubclass(ann, BaseForm):
-                            models.add(ann.model_cls)
+                yield route, method, handler, handler.__annotations__
+
+    def get_models_name(self, walked=None):
+        if walked is None:
+            walked = self._walk_routes()
+
+        models = set()
+        for route, method, handler, annotations in walked:
+            entries, handler_models = _analyze_handler(handler, tuple(sorted(route.param_convertors)))
+            models.update(handler_models)
 
         model_names = get_model_name_map(models)
         return model_names
@@ -279,30 +415,28 @@ class OpenApi(object):
     def get_openapi_operation(self, handler, route):
         operation = OpenApiOperation()
         operation.tags = route.endpoint.tags
-        method_annotations = handler.__annotations__
-        for ann_name, ann in method_annotations.items():
-            if ann_name == "return":
+        entries, handler_models = _analyze_handler(handler, tuple(sorted(route.param_convertors)))
+        for ann_name, kind, model in entries:
+            if kind == "return":
                 response = OpenApiOperationResponse(description="Success Response")
-                response.add_schema_content("application/json", self.models_name[ann])
+                response.add_schema_content("application/json", self.models_name[model])
                 operation.add_response(200, response)
 
-            elif ann_name == "body":
+            elif kind == "body":
                 request_body = OpenApiOperationRequest()
-                request_body.add_schema_content("application/json", self.models_name[ann])
+                request_body.add_schema_content("application/json", self.models_name[model])
                 operation.set_request_body(request_body)
 
-            elif ann_name == "form":
+            elif kind == "form":
                 request_body = OpenApiOperationRequest()
-                request_body.add_schema_content("multipart/form-data", self.models_name[ann.model_cls])
+                request_body.add_schema_content("multipart/form-data", self.models_name[model])
                 operation.set_request_body(request_body)
 
-            elif ann_name in route.param_convertors:
-                parameter = OpenApiOperationParameter(name=ann_name, location_in='path', required=True)
-                operation.add_parameters(parameter)
+            elif kind == "path":
+                operation.add_parameters(_operation_parameter(ann_name, 'path', True))
 
             else:
-                parameter = OpenApiOperationParameter(name=ann_name, location_in='query', required=False)
-                operation.add_parameters(parameter)
+                operation.add_parameters(_operation_parameter(ann_name, 'query', False))
 
         if hasattr(handler, 'auth_dict'):
             auth_dict = handler.auth_dict
@@ -318,31 +452,33 @@ class OpenApi(object):
 
         return operation
 
-    def get_openapi_path(self, route):
-        path = OpenApiPath()
-        for method in OpenApiPath.operations:
-            if not hasattr(route.endpoint, method):
-                continue
+    def get_openapi_paths(self, walked=None):
+        if walked is None:
+            walked = self._walk_routes()
 
-            handler = getattr(route.endpoint, method)
-            operation = self.get_openapi_operation(handler, route)
-            path.add_operation(method, operation)
-        return path
-
-    def get_openapi_paths(self):
         paths = OpenApiPaths()
-        for route in self.app.routes:
-            if not self.is_pydantic_endpoint(route.endpoint):
-                continue
+        for route, method, handler, annotations in walked:
+            convertors_key = tuple(sorted(route.param_convertors))
+            path_key = (route.endpoint, convertors_key)
+            path = self._path_cache.get(path_key)
+            if path is None:
+                path = OpenApiPath()
+                self._path_cache[path_key] = path
+
+            operation_key = (route.endpoint, handler, convertors_key)
+            operation = self._operation_cache.get(operation_key)
+            if operation is None:
+                operation = self.get_openapi_operation(handler, route)
+                self._operation_cache[operation_key] = operation
 
-            path = self.get_openapi_path(route)
+            path.add_operation(method, operation)
             paths.add_path(route.path, path)
         return paths
 
-    def get_openapi_components(self):
+    def get_openapi_components(self, schemas=None):
         components = OpenApiComponents()
-        model_list = list(self.models_name.keys())
-        schemas = schema(model_list, title='Pydantic_Schemas')['definitions']
+        if schemas is None:
+            schemas = _schema_definitions(list(self.models_name.keys()))
         components.set_schemas(schemas)
 
         for name, security_dict in self.securitySchemas_index.items():
@@ -358,14 +494,34 @@ class OpenApi(object):
 
         return components
 
-    def get_openapi_data(self, request):
-
-        if not self.api_schemas:
-            self.models_name = self.get_models_name()
-            info = OpenApiInfo(title=self.title, version=self.version, description=self.description)
-            paths = self.get_openapi_paths()
-            components = self.get_openapi_components()
-            openapi_data = OpenApiData(openapi="3.0.3", info=info, paths=paths, components=components)
-            self.api_schemas = openapi_data.dict()
+    def _build(self):
+        if self.api_bytes is not None:
+            return
+
+        walked = list(self._walk_routes())
+        self.models_name = self.get_models_name(walked)
+        info = OpenApiInfo(title=self.title, version=self.version, description=self.description)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            schemas_future = executor.submit(_schema_definitions, list(self.models_name.keys()))
+            paths = self.get_openapi_paths(walked)
+            components = self.get_openapi_components(schemas_future.result())
+        openapi_data = OpenApiData(openapi="3.0.3", info=info, paths=paths, components=components)
+        api_schemas = openapi_data.dict()
+        api_bytes = _json_dumps(api_schemas)
+        self.etag = '"' + hashlib.blake2b(api_bytes, digest_size=16).hexdigest() + '"'
+        self.api_headers = {
+            'content-length': str(len(api_bytes)),
+            'etag': self.etag,
+            'cache-control': 'public, max-age=3600',
+        }
+        self.api_schemas = api_schemas
+        # published last: the request path keys on api_bytes, so the etag and
+        # headers above must be visible before it is set
+        self.api_bytes = api_bytes
 
-        return JSONResponse(self.api_schemas)
+    def get_openapi_data(self, request):
+        if self.api_bytes is None:
+            self._build()
+        if self.etag is not None and request.headers.get('if-none-match') == self.etag:
+            return Response(status_code=304, headers={'etag': self.etag})
+        return Response(self.api_bytes, media_type="application/json", headers=self.api_headers)